@@ -20,7 +20,7 @@ Rename the files to HTML title, keeping existing suffix.
 
 ## Advanced Usage
 
-Hoto can extract HTML tags using CSS selectors. This is similar to jQuery and pyQuery. Hoto uses pyQuery library for tag extraction. 
+Hoto can extract HTML tags using CSS selectors. This is similar to jQuery and pyQuery. Hoto uses selectolax (Lexbor) library for tag extraction. 
 
 	$ hoto.py tero.html --format="{sel.h2}"
 	Python weppipalvelu - ideasta tuotantoon Palvelinten Hallinta Tunkeutumistestaus Information Security WebGoat with Podman Making Zero Days New Course: Network A	
@@ -35,7 +35,7 @@ If you leave out curly brackets, they are added automatically.
 	$ hoto.py tero.html -f sel.title
 	Tero Karvinen - Learn Free software with me
 
-All CSS selectors supported by pyQuery are available. For more complex selectors, use function syntax. Single quotes '' are required on function syntax. 
+All CSS selectors supported by Lexbor are available, plus pyQuery style ':first' at the end of selector. For more complex selectors, use function syntax. Single quotes '' are required on function syntax. 
 
 	$ ./hoto.py tero.html -f "sel('h2:first')" # single quotes required with sel('')
 	Python weppipalvelu - ideasta tuotantoon
@@ -87,17 +87,31 @@ from logging import info, debug, error, warning, INFO, WARNING, DEBUG
 import argparse
 from pathlib import Path
 
-from types import SimpleNamespace
+from types import SimpleNamespace, CodeType
 from datetime import datetime
 import re
 import zipfile
-from lxml import etree
+import mmap
+import contextlib
+import io
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 import unicodedata
 
-from pyquery import PyQuery as pq # apt-get install python3-pyquery
-from rdflib import Graph # apt-get install python3-rdflib
+from selectolax.lexbor import LexborHTMLParser, SelectolaxError # pip install selectolax
+
+MAX_CHARS = 160 # default --max-chars, for each selector
+MMAP_MIN_SIZE = 1024*1024 # bytes, smaller MAFF files are read without mmap
+SUGGEST_KEYS = "sel.h1 sel('h1:first') sel.title sel('h2:first') sel('h1',find='Tero',replace='Someone') path path.suffix path.name rdf.nonexistingkey rdf.originalurl rdf.archived rdf.year sel.__description sel.__keywords title ext h1 year filename stem host".split(" ")
+RDF_NAMES = {"rdf", "archived", "host", "year"}
+RDF_KEYS = frozenset(["title", "originalurl", "archivetime", "indexfilename"])
+RDF_XPATH = "//*["+" or ".join(f"local-name()='{key}'" for key in sorted(RDF_KEYS))+"]"
+INLINE_TAGS = frozenset("a abbr acronym b bdo big br button cite code dfn em i img input kbd label map object q samp script select small span strong sub sup textarea time tt var".split()) # same as pyQuery, other tags are blocks
+HTML_WHITESPACE = re.compile("[\x20\x09\x0C\u200B\x0A\x0D]+") # not &nbsp;, like pyQuery
+FILENAME_BADCHARS = re.compile(r"[:/^\[\]\.]")
+FILENAME_TRANSLIT = str.maketrans("äöåÄÖÅéèáàüÜÉ", "aoaAOAeeaauUE")
 
 ### Argument parsing ###
 
@@ -118,7 +132,7 @@ def parseArgs():
 
 	# Main args
 	parser.add_argument("files", nargs="*", help="HTML and MAFF files")
-	parser.add_argument("--format", "-f", help="Output format, Python f-string syntax. Can run almost any Python code. See --help for using selectors (sel.h1) and specials.", default="{h1}.{ext}" )
+	parser.add_argument("--format", "-f", help="Output format, Python f-string syntax. Can run almost any Python code. See --help for using selectors (sel.h1) and specials. Variables title, h1, year, archived and host are only defined when named in the format, so indirect use like {locals()} or {eval('h1')} does not see them. Likewise, MAFF index.rdf is only parsed when rdf or one of its variables is named, otherwise {eval('rdf.host')} is None.", default="{h1}.{ext}" )
 
 	# Helper args
 	parser.add_argument("-v", "--verbose", action="store_const", dest="log_level", const=INFO, default=WARNING, help="Set logging level to verbose (INFO)")
@@ -128,15 +142,11 @@ def parseArgs():
 	parser.add_argument("--suggest", "-s", default=False, action=argparse.BooleanOptionalAction, help='''Suggest tags and metadata for files, showing both selectors "{sel.h1}" and matches "Tero's homepage".''')
 	parser.add_argument("--rename", default=False, action=argparse.BooleanOptionalAction, help='''Rename files to output format.''')
 	parser.add_argument("--maff-html-file-name", "-m", default="index.html", help='''HTML file to analyze inside MAFF archive. If one HTML file embeds another, the main is often included with an alternate name, such as "index_1.html".''')
+	parser.add_argument("--max-chars", type=int, default=MAX_CHARS, help='''Maximum length of text extracted with each selector.''')
 	parser.add_argument("--no-action", "-n", default=False, action=argparse.BooleanOptionalAction, help='''Does not actually modify any files, but shows what would happen.''')
 	args = parser.parse_args()
 
-	## Set up logging
-	if args.log_level == DEBUG:
-		logformat="%(funcName)s():%(lineno)i: %(message)s %(levelname)s"
-	else:
-		logformat="%(message)s"
-	logging.basicConfig(level=args.log_level, format=logformat)
+	setupLogging(args.log_level)
 	debug(args)
 
 	## Validate arguments
@@ -150,36 +160,168 @@ def parseArgs():
 			error(f'"{path}" does not exist or is not a file! Try --help. Exiting...')
 			sys.exit(1)
 		args.paths.append(path)
+	if args.max_chars < 1:
+		error(f'--max-chars must be 1 or more, got {args.max_chars}. Try --help. Exiting...')
+		sys.exit(1)
 	### Warn for likely incorrect parameters
 	if not '{' in args.format:
 		args.format = '{'+args.format+'}'
 		info(f'''Automatically added curly brackets around your format string to make it variable. Your format string is now --format="{args.format}" ''')
 		# warning(f'''Warning: Format string does not contain any variables. Variables must be surrounded by curly brackets "{{}}" aka whiskers. Correct: --format="{{sel.h1}}", prints the result of selecting h1 in HTML. Incorrect: --format="sel.h1", which prints literal text "sel.h1". Your current --format is "{args.format}".''')
+	try:
+		compileFormat(args.format)
+	except SyntaxError as e:
+		error(f'Invalid --format="{args.format}": {e.msg}. Try --help. Exiting...')
+		sys.exit(1)
+	### Only extract variables that are used
+	codes = [code for key, code in compileSuggest()] if args.suggest else [compileFormat(args.format)]
+	args.names = frozenset().union(*(codeNames(code) for code in codes))
+	args.needsRdf = bool(args.names & RDF_NAMES)
+	debug(f"Names used: {sorted(args.names)}, needs RDF: {args.needsRdf}")
 
 	return args
 
+def setupLogging(logLevel):
+	"Configure logging. Also called in each worker process, which don't inherit it with spawn or forkserver start methods."
+	if logLevel == DEBUG:
+		logformat="%(funcName)s():%(lineno)i: %(message)s %(levelname)s"
+	else:
+		logformat="%(message)s"
+	logging.basicConfig(level=logLevel, format=logformat)
+
+@functools.cache
+def compileFormat(format):
+	"Compile --format to f-string code once, instead of parsing it again for every file"
+	return compile('f"'+format+'"', "<format>", "eval") # f"sel.h1"
+
+def codeNames(code):
+	"Names used by compiled code, including nested lambdas and comprehensions. Attribute names are included, too."
+	names = set(code.co_names)
+	for const in code.co_consts:
+		if isinstance(const, CodeType):
+			names |= codeNames(const)
+	return names
+
+@functools.cache
+def compileSuggest():
+	"Compile --suggest expressions once, only when --suggest is used. Returns [(key, code)]"
+	return [(key, compile(key, "<suggest>", "eval")) for key in SUGGEST_KEYS]
+
 ### Tag and Metadata Extraction ###
 
+@functools.cache
+def compileFind(find):
+	"Compile find regex once, the same selector often runs for many files"
+	return re.compile(find)
+
+def joinParts(parts):
+	"Join nodeTexts() parts to text: squash whitespace in each text run, newline for blocks and <br>, like pyQuery"
+	lines = []
+	run = []
+	for part in parts+[None]:
+		if isinstance(part, str):
+			run.append(part)
+			continue
+		text = HTML_WHITESPACE.sub(" ", "".join(run)).strip()
+		run = []
+		if text:
+			lines.append(text)
+		if lines and (part is True or lines[-1] is not None):
+			lines.append(part)
+	while lines and not isinstance(lines[-1], str):
+		lines.pop()
+	return "".join("\n" if not isinstance(line, str) else line for line in lines).strip()
+
+def nodeTexts(nodes):
+	"""Texts of nodes and their descendants, like pyQuery text(). Inline tags don't split words, 
+	blocks and <br> become newlines, other whitespace is squashed.
+	One iterative walk: nodes nested in other matched nodes reuse their ancestor's parts, and deep nesting is fine."""
+	wanted = {node.mem_id for node in nodes}
+	spans = {} # mem_id: [start, end] in parts
+	parts = [] # text, None at block boundaries, True at <br>
+	for node in nodes:
+		if node.mem_id in spans: # already walked inside an ancestor
+			continue
+		stack = [node]
+		while stack:
+			current = stack.pop()
+			if current is None: # leaving block
+				parts.append(None)
+				continue
+			if isinstance(current, int): # leaving wanted node, mem_id
+				spans[current][1] = len(parts)
+				continue
+			tag = current.tag
+			if tag == "-text":
+				parts.append(current.text_content)
+				continue
+			if tag.startswith("-"): # comment
+				continue
+			if current.mem_id in wanted:
+				spans[current.mem_id] = [len(parts), None]
+				stack.append(current.mem_id)
+			if tag == "br":
+				parts.append(True)
+			elif not tag in INLINE_TAGS:
+				parts.append(None)
+				stack.append(None)
+			stack.extend(reversed(list(current.iter(include_text=True))))
+	return [joinParts(parts[start:end]) for start, end in (spans[node.mem_id] for node in nodes)]
+
 class Selector():
 	"""Call this class from f-string to extract HTML tags, 
 	dot notation 'sel.h1' or function 'self("p:first")'
+
+	Inline tags don't split words, blocks and <br> are newlines. Test with 'python3 -m doctest hoto.py'
+	>>> Selector(b"<h1>Hello <em>wor</em>ld<span>!</span></h1>").h1
+	'Hello world!'
+	>>> Selector(b"<p>Don<b>'</b>t stop</p>").p
+	"Don't stop"
+	>>> Selector(b"<div><p>a</p><p>b</p>c<br>d<!-- x -->e</div>").div
+	'a\\nb\\nc\\nde'
+	>>> Selector(b"<h1> x&nbsp;y </h1><h1>z</h1>").h1
+	'x\\xa0y z'
 	"""
 
-	def __init__(self, htmlStr):
-		self.d = pq(htmlStr)
+	def __init__(self, htmlStr, maxChars=MAX_CHARS):
+		self.d = LexborHTMLParser(htmlStr)
+		self.maxChars = maxChars
+		self._cache = {} # (selector, find, replace, maxChars): text
 
-	def __get_selector__(self, selector, find=None, replace="", maxChars=160): 
+	def __get_selector__(self, selector, find=None, replace="", maxChars=None): 
 		# own function, underscores prevent overlap with tags
-		s = self.d(selector).text()
+		if maxChars is None:
+			maxChars = self.maxChars
+		key = (selector, find, replace, maxChars)
+		if key in self._cache:
+			return self._cache[key]
+		try:
+			if selector.endswith(":first"): # pyQuery extension, not supported by Lexbor
+				node = self.d.css_first(selector[:-len(":first")])
+				nodes = [node] if node else []
+			else:
+				nodes = self.d.css(selector)
+		except SelectolaxError:
+			error(f'Unsupported CSS selector "{selector}". Other pyQuery extensions than ending with ":first" (e.g. ":last", ":eq(1)") are not supported. Try --help. Exiting...')
+			sys.exit(1)
+		s = " ".join(nodeTexts(nodes))
 		if find:
-			s = re.sub(find, replace, s) # todo: multiline
-		return s.strip()[:maxChars]
+			s = compileFind(find).sub(replace, s) # todo: multiline
+		s = s.strip()[:maxChars]
+		self._cache[key] = s
+		return s
+
+	def __get_meta__(self, name):
+		node = self.d.css_first(f'meta[name="{name}"]')
+		if not node:
+			return None
+		return node.attributes.get("content")
 
 	def __getattr__(self, selector, find=None, replace=""): # dot notation: sel.h1
 		if "__description" == selector:
-			s = self.d('meta[name="description"]').attr("content")
+			s = self.__get_meta__("description")
 		elif "__keywords" == selector:
-			s = self.d('meta[name="keywords"]').attr("content")
+			s = self.__get_meta__("keywords")
 		else:
 			s = self.__get_selector__(selector, find=find, replace=replace)
 		if not s:
@@ -197,14 +339,17 @@ class RDF(dict):
 			debug('''No RDF found, empty RDF string.''')
 			return None
 
-		root = etree.fromstring(rdfStr)
-		for child in root:
-			for grandchild in child:
-				for key in "title originalurl archivetime indexfilename".split(" "):
-					if grandchild.tag.endswith("}"+key):
-						val = grandchild.attrib.values()[0]
-						# print(f"\t{val} - {key}")
-						self[key] = val
+		import pygixml # pip install pygixml. Imported here, only MAFF files need it
+		doc = pygixml.parse_string(rdfStr)
+		for match in doc.root.select_nodes(RDF_XPATH):
+			node = match.node
+			key = node.name.rpartition(":")[2] # MAF:title -> title
+			attr = node.attribute("RDF:resource") # WebScrapbook: <MAF:title RDF:resource="..."/>
+			if not attr: # other prefix than RDF:
+				attr = node.first_attribute()
+			val = attr.value
+			# print(f"\t{val} - {key}")
+			self[key] = val
 		if "archivetime" in self:
 			self.archiveDatetime = parsedate_to_datetime(self.archivetime)
 			self.archived = self.archiveDatetime.strftime("%Y-%m-%d w%V %a")
@@ -216,45 +361,65 @@ class RDF(dict):
 	__setattr__ = dict.__setitem__
 	__delattr__ = dict.__delitem__
 
+class SeekableMmap(mmap.mmap):
+	"Read only mmap usable as zipfile.ZipFile file object. mmap.seekable() only exists in Python 3.13 and later."
+	def seekable(self):
+		return True
+
+@contextlib.contextmanager
+def openZip(path):
+	"""Open ZIP file. Large files are memory mapped, so that zipfile reads straight from page cache, 
+	shared by parallel worker processes. For small files, mmap setup costs more than a normal read."""
+	with open(path, "rb") as fh:
+		if os.fstat(fh.fileno()).st_size < MMAP_MIN_SIZE:
+			with zipfile.ZipFile(fh) as zf:
+				yield zf
+			return
+		debug(f'''Memory mapping large ZIP file "{path}" ''')
+		with SeekableMmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, zipfile.ZipFile(mm) as zf:
+			yield zf
+
 def readPath(path, args):
-	"Read pathlib.Path path to string, optionally extracting files from inside MAFF zip"
+	"Read pathlib.Path path to HTML bytes and RDF string, optionally extracting files from inside MAFF zip"
 	info(f'Reading "{path}"...')
-	# verify arguments
-	if not path.is_file():
-		error(f'"{path}" does not exist or is not a file! Try --help. Exiting...')
-		sys.exit(1)
-		
+	# path is already verified to be a file in parseArgs()
+
 	# easy plain HTML first, for early exit
 	if not path.suffix in [".maff", ".zip"]:
 		debug(f'''Reading plain HTML file "{path}" (suffix: "{path.suffix}") ''')
-		htmlStr = path.read_text(encoding="utf-8", errors="replace")
+		htmlStr = path.read_bytes() # Lexbor decodes UTF-8 and replaces errors
 		return htmlStr, None
 
 	debug(f'''Reading ZIP file "{path}" ''')
+	htmlStr = None
 	rdfStr = None
-	with zipfile.ZipFile(path) as zf:
-		names = zf.namelist()
-		for zippedFile in  zf.namelist():
-			if zippedFile.endswith("/index.rdf"):
+	with openZip(path) as zf:
+		for zipInfo in zf.infolist():
+			zippedFile = zipInfo.filename
+			if args.needsRdf and rdfStr is None and zippedFile.endswith("/index.rdf"):
 				debug(f'''matched index.rdf: "{zippedFile}"''')
-				with zf.open(zippedFile, "r") as f:
-					b = f.read()
-					rdfStr = b.decode("utf-8")
-			if zippedFile.endswith("/"+args.maff_html_file_name):
+				with io.TextIOWrapper(zf.open(zipInfo), encoding="utf-8") as f:
+					rdfStr = f.read()
+			elif htmlStr is None and zippedFile.endswith("/"+args.maff_html_file_name):
 				debug(f'''matched {args.maff_html_file_name}: "{zippedFile}"''')
-				with zf.open(zippedFile, "r") as f:
-					b = f.read()
-					htmlStr = b.decode("utf-8")
+				htmlStr = zf.read(zipInfo) # bytes, Lexbor decodes it in C
+			if htmlStr is not None and (rdfStr is not None or not args.needsRdf):
+				break
+	if htmlStr is None:
+		error(f'"{path}" does not contain "{args.maff_html_file_name}"! Try --maff-html-file-name. Exiting...')
+		sys.exit(1)
 	return htmlStr, rdfStr
 
 def filenameClean(s, keepext=None):
 	if keepext and s.endswith("."+keepext):
 		# debug(f'Keeping extension "{keepext}"')
 		s = s.replace("."+keepext, "")
-	s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore') # convert scandics to aaoAAO
-	s = s.decode("ascii", "ignore")
+	s = s.translate(FILENAME_TRANSLIT) # convert scandics to aaoAAO
+	if not s.isascii(): # rare characters, slower generic way
+		s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore')
+		s = s.decode("ascii", "ignore")
 	assert type(s) == str
-	s = re.sub("[:/^\[\]\.]", "_", s)
+	s = FILENAME_BADCHARS.sub("_", s)
 	if keepext:
 		s += "."+keepext
 		debug(f'Keeping extension "{keepext}".')
@@ -262,54 +427,81 @@ def filenameClean(s, keepext=None):
 
 ### main ###
 
-def processFile(path, args):
+CONVENIENCE_VARIABLES = { # expensive, only extracted when named in format
+	"title": lambda sel, rdf, path: sel.title,
+	"h1": lambda sel, rdf, path: sel.h1,
+	"year": lambda sel, rdf, path: rdf.year,
+	"archived": lambda sel, rdf, path: rdf.archived,
+	"host": lambda sel, rdf, path: rdf.host,
+}
+
+def extractFile(path, args):
+	"""Extract --format result, or --suggest listing, from file.
+	Only returns, does not print or rename, so that it can run in a worker process."""
 	info(f'## Processing file "{path}"')
 	htmlStr, rdfStr = readPath(path, args)	
 
 	info(f'### Extracting Tags and Metadata from "{path}"')
-	sel = Selector(htmlStr)
+	sel = Selector(htmlStr, maxChars=args.max_chars)
 	rdf = RDF(rdfStr)
 
 	info(f"### Adding Convenience Variables (like title, desc...)")
-	title = sel.title
-	h1 = sel.h1
-	ext = path.suffix.replace(".", "")
-	year = rdf.year
-	filename = path.name
-	stem = path.stem
-	archived = rdf.archived
-	host = rdf.host
+	ns = dict(sel=sel, rdf=rdf, path=path, ext=path.suffix.replace(".", ""), filename=path.name, stem=path.stem) # cheap, always defined
+	for name, get in CONVENIENCE_VARIABLES.items():
+		if name in args.names:
+			ns[name] = get(sel, rdf, path)
 
 	if args.suggest:
-		print("## ", path)
-		for key in "sel.h1 sel('h1:first') sel.title sel('h2:first') sel('h1',find='Tero',replace='Someone') path path.suffix path.name rdf.nonexistingkey rdf.originalurl rdf.archived rdf.year sel.__description sel.__keywords title ext h1 year filename stem host".split(" "):
-			key = key.strip()
-			val = eval(key)
+		lines = [f"##  {path}"]
+		scope = globals()
+		for key, code in compileSuggest():
+			val = eval(code, scope, ns)
 			if not val:
 				val = "(not found)"
-			print(f"{val} - {key}")
-		return
+			lines.append(f"{val} - {key}")
+		return "\n".join(lines)
+
+	return eval(compileFormat(args.format), globals(), ns) # "Tero's Homepage"
 
-	formatString = 'f"'+args.format+'"' # f"sel.h1"
-	extracted = eval(formatString) # "Tero's Homepage"
-	
-	if not args.rename:
+def processFile(path, extracted, args):
+	"Print or rename, in the main process, so that output stays in the order of files given"
+	if args.suggest or not args.rename:
 		print(extracted)
 		return
 
+	ext = path.suffix.replace(".", "")
 	extracted = filenameClean(extracted, keepext=ext)
-	new = path.parent.joinpath(extracted)
+	new = os.path.join(os.path.dirname(os.fspath(path)), extracted) # plain str, same directory
 	if args.no_action:
 		warning("Simulating only, no files will be modified. (--no-action)")
 	print(f'''"{path}" ->\n \t"{new}" ''')
 	if not args.no_action:
-		path.rename(new)
+		os.rename(os.fspath(path), new)
 		warning("Renamed file.")
 
+WORKER_ARGS = ["suggest", "format", "names", "needsRdf", "maff_html_file_name", "max_chars"] # what extractFile() reads
+
+def initWorker(logLevel, args):
+	"ProcessPoolExecutor initializer. Sends args once per worker, instead of pickling them into every task."
+	global workerArgs
+	setupLogging(logLevel)
+	workerArgs = args
+
+def extractInWorker(path):
+	return extractFile(path, workerArgs)
+
 def main():
 	args=parseArgs()
-	for path in args.paths:
-		processFile(path, args)
+	workers = min(len(args.paths), os.cpu_count() or 1)
+	if workers > 1: # files are independent, extract in parallel
+		workerArgs = SimpleNamespace(**{name: getattr(args, name) for name in WORKER_ARGS})
+		chunksize = max(1, len(args.paths) // (workers*4))
+		with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(args.log_level, workerArgs)) as executor:
+			for path, extracted in zip(args.paths, executor.map(extractInWorker, args.paths, chunksize=chunksize)):
+				processFile(path, extracted, args)
+	else: # one file or one CPU, a pool would only add overhead
+		for path in args.paths:
+			processFile(path, extractFile(path, args), args)
 
 if __name__ == "__main__":
 	main()